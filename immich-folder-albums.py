@@ -1,16 +1,45 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from operator import itemgetter
 from pathlib import Path
+from typing import Iterable
 from threading import Lock
 import argparse
+import atexit
+import bisect
+import functools
 import logging
 import sys
 import os
 import re
+import time
 
 from scheduler import Scheduler
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    from itertools import batched
+except ImportError:
+    # Python < 3.12
+    def batched(iterable, n):
+        iterator = iter(iterable)
+        while chunk := tuple(islice(iterator, n)):
+            yield chunk
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 import dotenv
 dotenv.load_dotenv()
 
@@ -19,32 +48,92 @@ logger = logging.getLogger(__name__)
 
 lock = Lock()
 
+# Max number of concurrent API requests (must not exceed the session pool size)
+MAX_WORKERS = 16
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float|None = None):
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens can go negative: each caller reserves its slot and waits for it outside the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
 
 class ImmichAPI:
-    def __init__(self, api_url: str, token: str):
+    def __init__(self, api_url: str, token: str, max_rate: float|None = None):
         self.api_url = api_url
         self._token = token
-        self._headers = {
+        self._rate_limiter = TokenBucket(max_rate) if max_rate else None
+
+        # Reuse connections to the Immich server across requests (keep-alive)
+        self._session = requests.Session()
+        self._session.headers.update({
             "X-API-Key": self._token
-        }
+        })
+        # 429 and 503 responses are retried after the delay given by their Retry-After header, if any.
+        # POST isn't retried on errors, as it could create duplicate albums
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=64,
+            pool_block=True,
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.3,
+                status_forcelist=[429, 502, 503, 504],
+                allowed_methods=frozenset(["GET", "PUT", "DELETE"]),
+            ),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _throttle(self):
+        if self._rate_limiter:
+            self._rate_limiter.acquire()
 
     def _get_request(self, endpoint: str, params: dict = {}) -> dict | list:
-        r = requests.get(f"{self.api_url}{endpoint}", params=params, headers=self._headers)
+        self._throttle()
+        r = self._session.get(f"{self.api_url}{endpoint}", params=params)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
     def _post_request(self, endpoint: str, data) -> dict | list:
-        r = requests.post(f"{self.api_url}{endpoint}", json=data, headers=self._headers)
+        self._throttle()
+        r = self._session.post(f"{self.api_url}{endpoint}", json=data)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
     def _put_request(self, endpoint: str, data) -> dict | list:
-        r = requests.put(f"{self.api_url}{endpoint}", json=data, headers=self._headers)
+        self._throttle()
+        r = self._session.put(f"{self.api_url}{endpoint}", json=data)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
     def _delete_request(self, endpoint: str):
-        r = requests.delete(f"{self.api_url}{endpoint}", headers=self._headers)
+        self._throttle()
+        r = self._session.delete(f"{self.api_url}{endpoint}")
         r.raise_for_status()
 
     def get_albums(self) -> list[dict]:
@@ -61,6 +150,9 @@ class ImmichAPI:
             "path": str(path)
         })
 
+    def get_folder_assets_ids(self, path: str | Path) -> list[str]:
+        return list(map(itemgetter('id'), self.get_folder_assets(path)))
+
     def create_album(self, name: str, description: str = "", assets_ids: list[str] = []) -> dict:
         data = {
             "albumName": name,
@@ -81,47 +173,102 @@ class ImmichAPI:
     def delete_all_albums(self):
         albums = self.get_albums()
         albums_ids = [album['id'] for album in albums]
-        for album_id in albums_ids:
-            self.delete_album(album_id)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            list(executor.map(self.delete_album, albums_ids))
 
 
-def find_album_by_name(album_name: str, albums: list[dict]) -> str:
-    for album in albums:
-        if album['albumName'] == album_name:
-            return album['id']
-    return None
-
-def process_album_name(regexp: str|None, folder_name: str) -> str:
+def process_album_name(regexp: re.Pattern|None, folder_name: str) -> str:
     if not regexp:
         return folder_name
-    m = re.search(regexp, folder_name)
+    m = regexp.search(folder_name)
     return m.group() if m else folder_name
 
+@functools.lru_cache(maxsize=1024)
+def _load_album_props(path: str, mtime_ns: int) -> dict:
+    # mtime_ns is only part of the cache key, so that modified files are parsed again
+    with open(path) as f:
+        album_props: dict|None = yaml.load(f, Loader=YamlLoader)
+    return album_props if album_props else dict()
+
+def load_album_props(path: str) -> dict:
+    return _load_album_props(path, os.stat(path).st_mtime_ns)
+
+def find_subpaths(sorted_paths: list[str], root: str) -> list[str]:
+    """Return `root` and all paths under `root` found in a sorted list of paths"""
+    i: int = bisect.bisect_left(sorted_paths, root)
+    subpaths: list[str] = [root] if i < len(sorted_paths) and sorted_paths[i] == root else []
+
+    # Paths under root are contiguous in the sorted list, but not necessarily right after root itself
+    prefix: str = os.path.join(root, '')
+    i = bisect.bisect_left(sorted_paths, prefix, i)
+    while i < len(sorted_paths) and sorted_paths[i].startswith(prefix):
+        subpaths.append(sorted_paths[i])
+        i += 1
+    return subpaths
+
 def run(args: argparse.Namespace, api: ImmichAPI):
     if not lock.acquire(blocking=False):
         return False
 
+    try:
+        create_albums(args, api)
+    finally:
+        lock.release()
+
+def scheduled_run(args: argparse.Namespace, api: ImmichAPI):
+    # Exceptions would otherwise stop the scheduler thread, and no further run would happen
+    try:
+        run(args, api)
+    except Exception:
+        logger.exception("Run failed, retrying at the next scheduled time")
+
+def create_albums(args: argparse.Namespace, api: ImmichAPI):
     if args.delete_all_albums:
         logger.debug("Deleting all albums...")
         api.delete_all_albums()
 
-    logger.debug("Retrieving existing albums...")
-    immich_albums: list[dict] = api.get_albums()
+    logger.debug("Retrieving existing albums and folders...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        immich_albums_future = executor.submit(api.get_albums)
+        unique_paths_future = executor.submit(api.get_unique_paths)
+        immich_albums: list[dict] = immich_albums_future.result()
+        immich_unique_paths: list[str] = unique_paths_future.result()
 
-    unique_paths: list[Path] = [Path(p) for p in api.get_unique_paths()]
-    potential_albums: set[Path] = {*unique_paths}
+    # Reversed so that the first album wins if several albums have the same name
+    albums_names_ids: dict[str, str] = {album['albumName']: album['id'] for album in reversed(immich_albums)}
 
-    for path in unique_paths:
-        potential_albums.update(path.parents)
+    # Paths are handled as plain strings, which is much cheaper than Path objects for thousands of folders
+    unique_paths: list[str] = [os.path.normpath(p) for p in immich_unique_paths]
+    potential_albums: set[str] = {*unique_paths}
 
-    albums: list[Path] = [p for p in potential_albums if (p / '.album').is_file()]
+    parents: set[str] = set()
+    for path in unique_paths:
+        parent: str = os.path.dirname(path)
+        # Stop as soon as a parent has already been seen, as all of its own parents have been seen as well
+        while parent not in parents:
+            parents.add(parent)
+            if parent == os.path.dirname(parent):
+                break
+            parent = os.path.dirname(parent)
+    potential_albums.update(parents)
+
+    # Stat calls release the GIL, which pays off on network mounted libraries
+    potential_albums: list[str] = list(potential_albums)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        is_album: list[bool] = list(executor.map(lambda p: os.path.isfile(os.path.join(p, '.album')), potential_albums))
+    albums: list[str] = [p for p, p_is_album in zip(potential_albums, is_album) if p_is_album]
+    sorted_paths: list[str] = sorted(unique_paths)
+    unique_paths_set: set[str] = set(unique_paths)
+
+    # Album (id, name) and folders containing assets of each album root
+    albums_ids: dict[str, tuple[str, str]] = dict()
+    albums_folders: dict[str, list[str]] = dict()
 
     for album_root in sorted(albums):
         logger.info(f"{album_root}")
 
-        album_props: dict|None = yaml.safe_load(open(album_root / '.album'))
-        album_props: dict = album_props if album_props else dict()
-        album_name: str = album_props.get("name", process_album_name(args.album_regex, album_root.name))
+        album_props: dict = load_album_props(os.path.join(album_root, '.album'))
+        album_name: str = album_props.get("name", process_album_name(args.album_regex, os.path.basename(album_root)))
         album_desc: str = album_props.get("description", "")
         album_order: str = album_props.get("order", "desc")
         recursive: bool = album_props.get("recursive", True)
@@ -130,35 +277,54 @@ def run(args: argparse.Namespace, api: ImmichAPI):
         if args.dry_run:
             continue
 
-        album_id: str|None = find_album_by_name(album_name, immich_albums)
+        album_id: str|None = albums_names_ids.get(album_name)
         if album_id is None:
             logger.info(f"\tCreating new album '{album_name}'")
             new_album: dict = api.create_album(album_name, album_desc)
             album_id: str = new_album['id']
+            albums_names_ids[album_name] = album_id
 
-        album_assets_ids: set[str] = {asset['id'] for asset in api.get_folder_assets(album_root)}
-
+        # Only folders containing assets are listed in unique paths, no need to query the others
         if recursive:
-            for path in unique_paths:
-                if path.is_relative_to(album_root):
-                    folder_assets: list[dict] = api.get_folder_assets(path)
-                    album_assets_ids.update(asset['id'] for asset in folder_assets)
+            album_folders: list[str] = find_subpaths(sorted_paths, album_root)
+        else:
+            album_folders: list[str] = [album_root] if album_root in unique_paths_set else []
+
+        albums_folders[album_root] = album_folders
+        albums_ids[album_root] = (album_id, album_name)
 
-        album_assets_ids: list[str] = list(album_assets_ids)
-        logger.info(f"\t{len(album_assets_ids)} assets found")
+    # Fetch the assets of all needed folders at once, each folder only once
+    # even if it belongs to several (nested) albums
+    folders: list[str] = list({folder for album_folders in albums_folders.values() for folder in album_folders})
+    logger.debug(f"Retrieving assets of {len(folders)} folders...")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        folders_assets_ids: dict[str, list[str]] = dict(zip(folders, executor.map(api.get_folder_assets_ids, folders)))
+
+    # (album id, album name, assets ids) of all pending API calls to add assets to albums
+    pending_chunks: list[tuple[str, str, tuple[str, ...]]] = []
+
+    for album_root, album_folders in albums_folders.items():
+        album_id, album_name = albums_ids[album_root]
+        # Merge and deduplicate the assets ids of all album folders in a single pass
+        album_assets_ids: set[str] = set(chain.from_iterable(map(folders_assets_ids.__getitem__, album_folders)))
+        logger.info(f"{album_root}: {len(album_assets_ids)} assets found")
 
         if args.chunk_size:
             # Add assets to albums by chunks
-            chunk_size: int = args.chunk_size
-            chunks: list[list[str]] = [album_assets_ids[i:i + chunk_size] for i in range(0, len(album_assets_ids), chunk_size)]
+            chunks: Iterable[tuple[str, ...]] = batched(album_assets_ids, args.chunk_size)
         else:
-            chunks: list[list[str]] = [album_assets_ids]
+            chunks: Iterable[tuple[str, ...]] = [tuple(album_assets_ids)]
+
+        pending_chunks.extend((album_id, album_name, chunk) for chunk in chunks)
 
-        for chunk in chunks:
-            logger.debug(f"\tAdding {len(chunk)} assets to album '{album_name}' (album id: {album_id})")
-            api.album_add_assets(album_id, chunk)
+    def add_chunk(pending_chunk: tuple[str, str, tuple[str, ...]]):
+        album_id, album_name, chunk = pending_chunk
+        logger.debug(f"Adding {len(chunk)} assets to album '{album_name}' (album id: {album_id})")
+        api.album_add_assets(album_id, list(chunk))
 
-    lock.release()
+    # Chunks are independent from each other (adding assets already in an album is a no-op)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(add_chunk, pending_chunks))
 
 
 def main():
@@ -167,6 +333,7 @@ def main():
     parser.add_argument("--api-key", type=str, help="Immich API key")
     parser.add_argument("-r", "--album-regex", type=str, help="Regexp to compute album name from folder name (default: just use folder name)")
     parser.add_argument("-s", "--chunk-size", type=int, help="Max number of assets to add to an album per API call (default: add all assets to each album in one API call). Sometimes the API call crash if there're too many assets in an album, try lowering this value if that's the case.")
+    parser.add_argument("-m", "--max-rate", type=float, help="Max number of API calls per second (default: unlimited)")
     parser.add_argument("-v", "--verbose", action='count', help="Increase verbosity level (up to -vv)")
     parser.add_argument("-n", "--dry-run", action="store_true", help="Don't create new albums, just print the name of the albums that would be created if used with -v (useful to test your regex)")
     parser.add_argument("-X", "--delete-all-albums", action="store_true", help="Delete all existing immich albums before proceeding (even with -n/--dry-run)")
@@ -177,6 +344,7 @@ def main():
         api_key =           os.getenv("IMMICH_API_KEY"),
         album_regex =       os.getenv("ALBUM_NAME_REGEX"),
         chunk_size =        os.getenv("API_CHUNK_SIZE"),
+        max_rate =          os.getenv("API_MAX_RATE"),
         verbose =           int(os.getenv("VERBOSE", 0)),
         dry_run =           bool(os.getenv("DRY_RUN", False)),
         delete_all_albums = bool(os.getenv("DELETE_ALL_ALBUMS", False)),
@@ -192,17 +360,27 @@ def main():
         print("The --api-url and --api-key parameters are required. Please specify them or use the IMMICH_API_URL and IMMICH_API_KEY environment variables.", file=sys.stderr)
         exit(1)
 
+    try:
+        args.album_regex = re.compile(args.album_regex) if args.album_regex else None
+    except re.error as e:
+        print(f"Invalid album name regex: {e}", file=sys.stderr)
+        exit(1)
+
     api = ImmichAPI(
         args.api_url,
-        args.api_key
+        args.api_key,
+        args.max_rate
     )
 
     if args.cron_expr:
+        # The scheduler runs in a background thread, keep the API session open across runs until exit
+        atexit.register(api.close)
         scheduler = Scheduler(60)
-        scheduler.add('run', args.cron_expr, run, (args, api))
+        scheduler.add('run', args.cron_expr, scheduled_run, (args, api))
         scheduler.start()
     else:
-        run(args, api)
+        with api:
+            run(args, api)
 
 
 if __name__ == '__main__':